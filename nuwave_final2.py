@@ -13,7 +13,7 @@ Pipeline:
   3. FFmpeg renders waveform + composites background + muxes audio in one pass
 
 Install:
-    pip install gradio librosa pydub imageio-ffmpeg pillow numpy psutil
+    pip install gradio librosa pydub mutagen imageio-ffmpeg pillow numpy psutil
 
 AI video (optional):
     pip install torch torchvision --index-url https://download.pytorch.org/whl/cu128
@@ -22,7 +22,8 @@ AI video (optional):
 Run:  python 4nuwavegradio.py  →  http://localhost:7860
 """
 
-import os, re, json, subprocess, tempfile, traceback, math
+import os, re, json, subprocess, tempfile, traceback, hashlib, glob
+import importlib.util
 import numpy as np
 import psutil
 from PIL import Image
@@ -34,6 +35,18 @@ try:
 except ImportError:
     LIBROSA_OK = False
 
+try:
+    import soundfile as sf
+    SOUNDFILE_OK = True
+except (ImportError, OSError):   # OSError: libsndfile itself can't be loaded
+    SOUNDFILE_OK = False
+
+try:
+    import mutagen
+    MUTAGEN_OK = True
+except ImportError:
+    MUTAGEN_OK = False
+
 try:
     from pydub import AudioSegment
     PYDUB_OK = True
@@ -54,11 +67,20 @@ except Exception as _fe:
     FFMPEG_CMD = 'ffmpeg'
 
 # ── LTX-Video ─────────────────────────────────────────────────────────────────
+# Only the lightweight diffusers / diffusers.pipelines packages are imported
+# here (find_spec needs them to resolve the dotted name). The LTX pipeline
+# module and transformers are imported on first generation — they cost
+# seconds of startup for a feature that may never be used in the session.
+# This only checks that the pieces are installed; a broken install is
+# still caught (once) by _load_ltx().
 LTX_AVAILABLE = False
 try:
     import torch
-    from diffusers import LTXImageToVideoPipeline
-    from diffusers.utils import export_to_video
+    # the LTX pipeline subpackage, not just diffusers: older releases lack it
+    if importlib.util.find_spec('diffusers.pipelines.ltx') is None:
+        raise ImportError('diffusers.pipelines.ltx')
+    if importlib.util.find_spec('transformers') is None:
+        raise ImportError('transformers')
     # Only mark as available if CUDA is actually usable
     if torch.cuda.is_available():
         LTX_AVAILABLE = True
@@ -89,22 +111,25 @@ NVENC_AVAILABLE = _detect_nvenc()
 if NVENC_AVAILABLE:
     print('✓ NVENC detected — using GPU hardware encoding (h264_nvenc)')
     # NVENC quality flags: -cq (constant quality) replaces -crf, -preset p4 = good balance
-    _VC   = ['h264_nvenc', '-preset', 'p4', '-cq', '22']
-    # For still-image sources NVENC doesn't support -tune stillimage — omit it
-    _VC_STILL = ['h264_nvenc', '-preset', 'p4', '-cq', '22']
+    _VC = ['h264_nvenc', '-preset', 'p4', '-cq', '22']
 else:
     print('  NVENC not available — using CPU encoding (libx264)')
-    _VC       = ['libx264', '-preset', 'fast', '-crf', '22']
-    _VC_STILL = ['libx264', '-preset', 'fast', '-crf', '22', '-tune', 'stillimage']
+    _VC = ['libx264', '-preset', 'fast', '-crf', '22']
 
 VID_W    = 704
 VID_H    = 480
 FPS      = 24
+# Audio fed to showwaves is resampled to one sample per pixel column per
+# frame — showwaves otherwise plots every raw sample (44.1k/s) into ~700
+# columns, most of it overdrawn. Channel layout is kept. Trade-off: the
+# resampler low-pass filters, so very short transients draw slightly flatter.
+WAVE_SR  = VID_W * FPS
 LTX_FRAMES = 97      # (97-1)%8==0 ✓
 LTX_STEPS  = 40
 LTX_NEG    = ('worst quality, inconsistent motion, blurry, jittery, '
                'distorted, low resolution, artifacts')
 LTX_PIPELINE = None
+BG_CACHE_MAX = 32    # scaled cover images kept in WORK_DIR (oldest pruned)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -114,8 +139,10 @@ LTX_PIPELINE = None
 def _run(args: list, desc: str = '') -> bool:
     """Run ffmpeg with args list. Returns True on success."""
     try:
+        # -nostats: ffmpeg otherwise rewrites a progress line on stderr every
+        # ~0.5 s for the whole render, all buffered here just to be dropped.
         r = subprocess.run(
-            [FFMPEG_CMD, '-y'] + args,
+            [FFMPEG_CMD, '-y', '-hide_banner', '-nostats'] + args,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
         )
@@ -138,6 +165,27 @@ def _hex_no_hash(h: str) -> str:
     return h.lstrip('#')
 
 
+def _file_sha1(path: str) -> str:
+    """SHA-1 of a file, read in 1 MiB chunks."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _prune_bg_cache():
+    """Keep only the BG_CACHE_MAX most recently used bg_*.png in WORK_DIR."""
+    try:
+        entries = sorted(glob.glob(os.path.join(WORK_DIR, 'bg_*.png')),
+                         key=os.path.getmtime, reverse=True)
+    except OSError:      # an entry vanished mid-scan (concurrent run)
+        return
+    for old in entries[BG_CACHE_MAX:]:
+        try: os.remove(old)
+        except OSError: pass
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # Theme from image
 # ══════════════════════════════════════════════════════════════════════════════
@@ -145,9 +193,13 @@ def _hex_no_hash(h: str) -> str:
 def derive_theme(img_path: str) -> dict:
     """Derive a color palette from the image automatically."""
     try:
-        img    = Image.open(img_path).resize((64, 64)).convert('RGB')
-        pixels = np.array(img).reshape(-1, 3).astype(float)
-        avg    = pixels.mean(axis=0)
+        img    = Image.open(img_path)
+        # JPEG: decode at reduced scale in the DCT domain (1/2..1/8) instead
+        # of decoding the full photo just to shrink it to 64x64.
+        img.draft('RGB', (64, 64))
+        img    = img.resize((64, 64)).convert('RGB')
+        pixels = np.asarray(img).reshape(-1, 3)   # uint8, no float64 copy
+        avg    = pixels.mean(axis=0)               # accumulates in float64
         dark   = pixels.min(axis=0)
 
         # Background: very dark version of image tones
@@ -178,30 +230,82 @@ def derive_theme(img_path: str) -> dict:
 # Audio duration (fast — no full decode needed for duration)
 # ══════════════════════════════════════════════════════════════════════════════
 
+def _ffprobe_cmds() -> list:
+    """ffprobe on PATH, then next to FFMPEG_CMD — skipped when that resolves to
+    the same binary, so a file ffprobe rejects isn't probed twice."""
+    probes = ['ffprobe']
+    alt = FFMPEG_CMD.replace('ffmpeg', 'ffprobe')
+    if alt not in probes:
+        probes.append(alt)
+    return probes
+
+
+# MP4 audio object types that are AAC (Main, LC, LTP, HE/SBR, HE v2) —
+# mp4a.40.34 etc. are MP3/other payloads in an MP4 container
+_MP4_AAC = ('mp4a.40.1', 'mp4a.40.2', 'mp4a.40.4', 'mp4a.40.5', 'mp4a.40.29')
+
+
+def get_audio_codec(path: str) -> str:
+    """Codec name of the first audio stream, e.g. 'aac' ('' if unknown).
+
+    'aac' is reliable; other names are best-effort. Uses mutagen when
+    available (no subprocess — imageio-ffmpeg ships no ffprobe), else ffprobe.
+    """
+    if MUTAGEN_OK:
+        try:
+            m = mutagen.File(path)
+            if m is not None:
+                kind  = type(m).__name__          # 'MP4', 'AAC' (ADTS), 'MP3'…
+                codec = getattr(m.info, 'codec', '')
+                if kind == 'AAC' or codec in _MP4_AAC:
+                    return 'aac'
+                return codec or kind.lower()
+        except Exception:
+            pass
+    for probe in _ffprobe_cmds():
+        try:
+            r = subprocess.run(
+                [probe, '-v', 'quiet', '-select_streams', 'a:0',
+                 '-show_entries', 'stream=codec_name',
+                 '-of', 'default=noprint_wrappers=1:nokey=1', path],
+                capture_output=True, text=True,
+            )
+            if r.returncode == 0:
+                return r.stdout.strip()
+        except Exception:
+            pass
+    return ''
+
+
 def get_audio_duration(path: str) -> float:
-    """Get duration in seconds using ffprobe (fast, any format)."""
-    try:
-        r = subprocess.run(
-            ['ffprobe', '-v', 'quiet', '-show_entries', 'format=duration',
-             '-of', 'default=noprint_wrappers=1:nokey=1', path],
-            capture_output=True, text=True,
-        )
-        if r.returncode == 0:
-            return float(r.stdout.strip())
-    except Exception:
-        pass
-    # fallback: use FFMPEG_CMD path for ffprobe
-    probe = FFMPEG_CMD.replace('ffmpeg', 'ffprobe')
-    try:
-        r = subprocess.run(
-            [probe, '-v', 'quiet', '-show_entries', 'format=duration',
-             '-of', 'default=noprint_wrappers=1:nokey=1', path],
-            capture_output=True, text=True,
-        )
-        if r.returncode == 0:
-            return float(r.stdout.strip())
-    except Exception:
-        pass
+    """Get duration in seconds from the file header, else ffprobe (any format)."""
+    # in-process header read (WAV/FLAC/OGG…) — no ffprobe subprocess spawn
+    if SOUNDFILE_OK:
+        try:
+            d = sf.info(path).duration
+            if d > 0:
+                return d
+        except Exception:
+            pass
+    # compressed formats (MP3/M4A/AAC…): stream header parse, no decode
+    if MUTAGEN_OK:
+        try:
+            m = mutagen.File(path)
+            if m is not None and m.info.length > 0:
+                return m.info.length
+        except Exception:
+            pass
+    for probe in _ffprobe_cmds():
+        try:
+            r = subprocess.run(
+                [probe, '-v', 'quiet', '-show_entries', 'format=duration',
+                 '-of', 'default=noprint_wrappers=1:nokey=1', path],
+                capture_output=True, text=True,
+            )
+            if r.returncode == 0:
+                return float(r.stdout.strip())
+        except Exception:
+            pass
     # last resort: pydub
     if PYDUB_OK:
         try:
@@ -222,11 +326,21 @@ def get_audio_duration(path: str) -> float:
 # ══════════════════════════════════════════════════════════════════════════════
 
 def _load_ltx():
-    global LTX_PIPELINE
+    global LTX_PIPELINE, LTX_AVAILABLE
     if LTX_PIPELINE is not None:
         return True, ''
     if not LTX_AVAILABLE:
-        return False, 'CUDA not available'
+        return False, 'LTX-Video not available'
+    # Broken/old diffusers or transformers: report once, then stay off.
+    # diffusers' lazy module wraps submodule import errors in RuntimeError;
+    # with transformers missing it hands back a dummy class whose
+    # from_pretrained raises ImportError instead.
+    try:
+        from diffusers import LTXImageToVideoPipeline
+    except (ImportError, RuntimeError) as ex:
+        print(f'LTX-Video import failed: {ex} – AI mode disabled')
+        LTX_AVAILABLE = False
+        return False, str(ex)
     try:
         pipe = LTXImageToVideoPipeline.from_pretrained(
             'Lightricks/LTX-Video', torch_dtype=torch.bfloat16)
@@ -235,6 +349,10 @@ def _load_ltx():
         pipe.vae.enable_slicing()
         LTX_PIPELINE = pipe
         return True, f'Loaded on {torch.cuda.get_device_name(0)}'
+    except ImportError as ex:
+        print(f'LTX-Video import failed: {ex} – AI mode disabled')
+        LTX_AVAILABLE = False
+        return False, str(ex)
     except Exception as ex:
         traceback.print_exc()
         return False, str(ex)
@@ -285,24 +403,43 @@ def generate_video(audio_file, image_path, progress=None):
     wave_hex = _hex_no_hash(theme['wave'])
 
     # ── Prepare scaled background image ───────────────────────────────────
+    # Cached in WORK_DIR by image content + pad colour, so re-using a cover
+    # skips the decode + scale entirely (uploads get a fresh temp path each
+    # time) and a change to derive_theme never serves a stale pad colour.
+    # At most BG_CACHE_MAX entries are kept; hits are touched so the
+    # least recently used covers are pruned first.
     _prog(0.08, 'Preparing background image…')
-    bg_scaled = os.path.join(WORK_DIR, 'bg_scaled.png')
-    _run([
-        '-i', img_path,
-        '-vf', (f'scale={VID_W}:{VID_H}:force_original_aspect_ratio=decrease,'
-                f'pad={VID_W}:{VID_H}:(ow-iw)/2:(oh-ih)/2:color={bg_hex}'),
-        bg_scaled,
-    ], 'scale bg')
+    img_key   = _file_sha1(img_path)[:16]
+    bg_scaled = os.path.join(WORK_DIR,
+                             f'bg_{img_key}_{bg_hex}_{VID_W}x{VID_H}.png')
+    bg_ok = os.path.exists(bg_scaled)
+    if bg_ok:
+        os.utime(bg_scaled)
+    else:
+        bg_tmp = os.path.join(WORK_DIR, f'bg_{img_key}_{bg_hex}.tmp.png')
+        bg_ok = _run([
+            '-i', img_path,
+            '-vf', (f'scale={VID_W}:{VID_H}:force_original_aspect_ratio=decrease,'
+                    f'pad={VID_W}:{VID_H}:(ow-iw)/2:(oh-ih)/2:color={bg_hex}'),
+            bg_tmp,
+        ], 'scale bg')
+        if bg_ok:
+            os.replace(bg_tmp, bg_scaled)   # never leave a partial cache entry
+        elif os.path.exists(bg_tmp):
+            os.remove(bg_tmp)
+        _prune_bg_cache()
 
     # ── LTX-Video AI base (optional) ───────────────────────────────────────
     _prog(0.10, 'Checking AI video generation…')
-    ai_base_video = None
-    use_ltx = False
+    bg_input  = None
+    bg_filter = ''        # filter_complex prefix producing the [bg] pad
+    use_ltx   = False
 
     ltx_ok, ltx_msg = _load_ltx()
     if ltx_ok:
         _prog(0.12, f'LTX-Video: generating {LTX_FRAMES} frames (~2-5 min)…')
         try:
+            from diffusers.utils import export_to_video
             input_img = Image.open(img_path).convert('RGB').resize(
                 (VID_W, VID_H), Image.Resampling.LANCZOS)
             result = LTX_PIPELINE(
@@ -319,18 +456,11 @@ def generate_video(audio_file, image_path, progress=None):
             ai_silent = os.path.join(WORK_DIR, 'ltx_silent.mp4')
             export_to_video(result.frames[0], ai_silent, fps=FPS)
 
-            # Loop AI clip to full audio duration
-            _prog(0.62, 'Looping AI clip to audio duration…')
-            ai_looped = os.path.join(WORK_DIR, 'ltx_looped.mp4')
-            ok = _run([
-                '-stream_loop', '-1',
-                '-i', ai_silent,
-                '-t', str(math.ceil(duration)),
-                '-c:v', *_VC, '-pix_fmt', 'yuv420p',
-                ai_looped,
-            ], 'loop ltx')
-            if ok and os.path.exists(ai_looped):
-                ai_base_video = ai_looped
+            # Loop AI clip to full audio duration — demuxer-level loop straight
+            # into the composite instead of re-encoding a looped copy first.
+            if os.path.exists(ai_silent):
+                bg_input  = ['-stream_loop', '-1', '-i', ai_silent]
+                bg_filter = '[0:v]null[bg];'
                 use_ltx = True
                 _prog(0.64, 'AI base ready')
         except Exception as ex:
@@ -340,22 +470,19 @@ def generate_video(audio_file, image_path, progress=None):
             print(f'LTX failed: {ex} — using static image')
             use_ltx = False
 
-    # ── Build background video (static image if no LTX) ───────────────────
+    # ── Static image background (if no LTX) ───────────────────────────────
+    # Fed straight into the composite pass — no intermediate MP4 encode
+    # (that was a full extra encode pass, decoded again by the composite).
+    # The PNG is decoded once and repeated by the loop filter; image2's
+    # -loop 1 would re-read and re-decode the file for every output frame.
+    # It is converted to overlay's yuv420p before looping, so the RGB→YUV
+    # conversion also happens once rather than on every repeated frame.
     if not use_ltx:
-        _prog(0.15, 'Building static image background video…')
-        static_vid = os.path.join(WORK_DIR, 'bg_static.mp4')
-        ok = _run([
-            '-loop', '1',
-            '-framerate', str(FPS),
-            '-i', bg_scaled,
-            '-t', str(math.ceil(duration)),
-            '-c:v', *_VC_STILL, '-pix_fmt', 'yuv420p',
-            static_vid,
-        ], 'static bg video')
-        if not ok:
-            return None, '❌ Failed to create background video'
-        ai_base_video = static_vid
-        _prog(0.30, 'Background video ready')
+        if not bg_ok:
+            return None, '❌ Failed to prepare background image'
+        bg_input  = ['-framerate', str(FPS), '-i', bg_scaled]
+        bg_filter = '[0:v]format=yuv420p,loop=loop=-1:size=1:start=0[bg];'
+        _prog(0.30, 'Background ready')
 
     # ══════════════════════════════════════════════════════════════════════
     # FFmpeg waveform composite — entire waveform rendered natively.
@@ -368,44 +495,53 @@ def generate_video(audio_file, image_path, progress=None):
     final = os.path.join(WORK_DIR, 'nuwave_final.mp4')
 
     # showwaves produces a scrolling waveform matched to the audio timeline.
-    # We blend it over the background at 70% opacity using overlay+colorkey.
+    # showwaves emits RGBA on a transparent background, so overlay blends it
+    # by its own alpha — no per-frame format round-trip + colorkey pass.
     wave_color_ffmpeg = wave_hex   # e.g. "00d4ff"
 
+    # AAC sources (M4A etc.) are stream-copied into the MP4: the audio is
+    # decoded once for showwaves anyway, so re-encoding it is pure overhead
+    # (and a second lossy generation).
+    if get_audio_codec(audio_path) == 'aac':
+        audio_codec = ['-c:a', 'copy']
+    else:
+        audio_codec = ['-c:a', 'aac', '-b:a', '192k']
+
     # filter_complex breakdown:
-    #   [0:v]               background video (AI loop or static image)
-    #   [1:a]showwaves      draw waveform from audio stream
-    #   scale2ref           scale waveform to match background size
-    #   colorkey            make black background transparent
-    #   overlay             composite waveform over background
+    #   [0:v] → [bg]        background (AI loop video or looped still image)
+    #   [1:a]aformat        resample to WAVE_SR (1 sample / column)
+    #   showwaves           draw waveform from audio stream
+    #   overlay             composite waveform over background; shortest=1
+    #                       ends on the audio, as the background loops forever
     filter_complex = (
-        f'[1:a]showwaves='
+        f'{bg_filter}'
+        f'[1:a]aformat=sample_rates={WAVE_SR},'
+        f'showwaves='
         f's={VID_W}x{VID_H//3}:'        # waveform height = bottom third
         f'mode=cline:'                    # continuous line mode (smooth)
         f'rate={FPS}:'
         f'colors={wave_color_ffmpeg}@0.9'
         f'[waves];'
-        f'[waves]format=yuva420p,'
-        f'colorkey=black:0.15:0.1'        # remove black bg → transparent
-        f'[waves_t];'
-        f'[0:v][waves_t]'
-        f'overlay=0:{VID_H - VID_H//3}'  # position at bottom of frame
+        f'[bg][waves]'
+        f'overlay=0:{VID_H - VID_H//3}:'  # position at bottom of frame
+        f'shortest=1'
         f'[v]'
     )
 
     ok = _run([
-        '-i', ai_base_video,             # [0] background video
+        *bg_input,                       # [0] background (video or still)
         '-i', audio_path,                # [1] audio (for showwaves + output)
         '-filter_complex', filter_complex,
         '-map', '[v]',
         '-map', '1:a',
         '-c:v', *_VC, '-pix_fmt', 'yuv420p',
-        '-c:a', 'aac', '-b:a', '192k',
+        *audio_codec,
         '-shortest',
         final,
     ], 'composite+encode')
 
     if not ok or not os.path.exists(final) or os.path.getsize(final) < 10_000:
-        # Fallback: simpler showwaves without overlay (no colorkey)
+        # Fallback: showwaves only, no background overlay
         _prog(0.80, 'Retrying with simplified waveform render…')
         filter_simple = (
             f'[0:v][1:a]'
@@ -427,7 +563,7 @@ def generate_video(audio_file, image_path, progress=None):
             '-map', '[v]',
             '-map', '0:a',
             '-c:v', *_VC, '-pix_fmt', 'yuv420p',
-            '-c:a', 'aac', '-b:a', '192k',
+            *audio_codec,
             final,
         ], 'fallback showwaves')
 
@@ -463,9 +599,14 @@ ltx_status = (
 )
 
 
+# Non-blocking CPU sampling: each call reports usage since the previous one,
+# so prime it once here instead of sleeping 0.3 s inside every UI callback.
+psutil.cpu_percent(interval=None)
+
+
 def _sys_info():
     vm  = psutil.virtual_memory()
-    cpu = psutil.cpu_percent(interval=0.3)
+    cpu = psutil.cpu_percent(interval=None)
     lines = [
         f'RAM: {vm.used/1e9:.1f}/{vm.total/1e9:.1f} GB ({vm.percent}%)',
         f'CPU: {cpu}%',